@@ -11,6 +11,8 @@
             If we change the model, we need to reingest all documents(vectors) into VectorDB
 """
 
+import os
+
 # Logger file settings
 _MAX_LOGFILESIZE = 5000000 #5MB files
 _MAX_LOG_BACKUP_FILES = 5
@@ -18,6 +20,9 @@ _MAX_LOG_BACKUP_FILES = 5
 # GET/POST Requests timeouts
 _GET_TIMEOUT = 1.0
 _POST_TIMEOUT = 5.0
+# Keep-alive connection pool per host and retries on 429/502/503/504
+_HTTP_POOL_MAXSIZE = 32
+_HTTP_RETRIES = 2
 
 # CUDA type for torch
 _CUDA_ARCHTYPE = "Ada"
@@ -31,6 +36,12 @@ _FTBASE = ["http://192.168.56.103:8983/solr",]
 _FTINDEX = "searchdocuments"
 _FTPOST = "update/json/docs"
 _FTGET = "select"
+# Full text documents are indexed in batches of N documents or ~M bytes of text
+_FT_BATCH_DOCS = 200
+_FT_BATCH_BYTES = 8000000 #8MB
+# POST timeout (seconds) for a full batch (_FT_BATCH_BYTES), Solr responds after indexing the batch
+# Smaller batches get a proportional timeout, not less than _POST_TIMEOUT
+_FT_POST_TIMEOUT = 60.0
 # verify certificates?
 _FTTLSVERIFY = False
 
@@ -44,9 +55,20 @@ _VECBASE = ["http://192.168.56.103:9200",]
 _VECINDEX = "searchdocuments"
 _VECPOST = "_bulk"
 _VECGET = "_search"
+# Chunks(embeddings) per bulk request, stay below OpenSearch http.max_content_length (100MB default)
+_VEC_BULK_DOCS = 500
+_VEC_BULK_BYTES = 50000000 #50MB
+# gzip the bulk requests larger than N bytes (OpenSearch http.compression, default enabled), 0 -> no gzip
+_VEC_GZIP_MIN_BYTES = 16384
 _VECTLSVERIFY = False
-# Return top N results from the vectorDB search
+# Return top N results from the vectorDB search (k nearest chunks)
+# djapp post filters the N chunks on the top 10 BM25 documents, the response has at most 10 chunks
 _MAX_VECSEARCH_RESULTS = 50
+# Cache embeddings of the last N search queries, skips the model forward pass on repeated queries
+_QRY_EMBED_CACHE_SIZE = 1024
+# torch.compile the embedding transformer, faster encode after the compile at model load
+# Requires triton (not available on Windows)
+_EMB_COMPILE = False
 
 
 # Text Generation/Summarization model, Using a small language model for performance
@@ -55,6 +77,9 @@ _MAX_VECSEARCH_RESULTS = 50
 
 # Saved models path
 _MODEL_PATH = "C:\\searchdocuments\\models"
+# Load models only from _MODEL_PATH, no HuggingFace Hub revision checks at startup
+# Set to False if the models are not pre-downloaded (see below)
+_HF_OFFLINE = True
 
 _LM_MDL = "HuggingFaceTB/SmolLM2-1.7B-Instruct"
 _LM_MSG_TMPLT = [{"role": "system",
@@ -63,12 +88,19 @@ _LM_MSG_TMPLT = [{"role": "system",
                  {"role": "user", "content": ''}
                 ]
 _LM_MAX_INPUT_TKNS = 2048
+# Load the model weights quantized (bitsandbytes), generation is memory bandwidth bound
+# "nf4" -> 4-bit NF4, "int8" -> 8-bit, Change to any text e.g. xxx to load in bfloat16
+_LM_QUANTIZATION = "nf4"
 # Max text generation/summarization output
 _LM_MAX_OUTPUT_TKNS = 512
 _DO_SAMPLE = True
 _TOP_K = 50
 _TOP_P = 0.95
 _REPETITION_PENALTY = 1.1
+# Dummy generations at startup, first user query does not pay CUDA kernel selection/allocator warmup
+_LM_WARMUP_RUNS = 3
+# Cache the last N generated responses, same question on the same documents is not regenerated
+_LM_RESP_CACHE_SIZE = 256
 
 
 # DOCLING related settings, vectorDB embeddings model
@@ -77,9 +109,21 @@ _CHUNKTOKENIZER = "nasa-impact/nasa-ibm-st.38m"
 
 # Configure the VectorDB dimension to match the model dimension
 _EMBED_DIM = 576
+# VectorDB vector type, "float" or "byte"
+# "byte" -> embeddings are unit normalized and quantized to int8, 4x less index memory, smaller payloads
+#   Requires the index mapping "chunkvec": {"type": "knn_vector", "dimension": _EMBED_DIM, "data_type": "byte"}
+#   (lucene engine, space_type cosinesimil), reingest all documents after the change
+_VEC_DATA_TYPE = "float"
 
 # Used by docling document chunker
 _MAXCHNKLEN = 512
+# Chunks encoded per batch when generating the document embeddings, lower it on GPU out of memory
+_EMBED_BATCH_SIZE = 64
+# SQLite file caching the chunk embeddings, unchanged chunks are not encoded again on reindexing
+# Next to the _MODEL_PATH folder. The cache is never pruned, it grows with every new chunk
+# (~1.2KB per chunk), delete the file to reclaim space
+# Delete the file if _CHUNKTOKENIZER is changed. Set to "" to disable the cache
+_EMB_CACHE_DB = os.path.join(os.path.dirname(_MODEL_PATH), "embcache.db")
 
 # PDF options, Change the backend to any text e.g. xxx to use the default backend
 # "pypdfium" backend is faster and more memory efficient than the default backend
@@ -92,6 +136,17 @@ _PICTURE_IMAGES = False
 _TABLE_STRUCTURE = True
 _CELL_MATCHING = True
 _NUM_THREADS = 4
+# Document conversion processes, each worker owns a Docling converter (CPU/GPU memory per worker)
+# 0 -> convert in the main process, one document at a time
+_NUM_WORKERS = 0
+# Large pdfs (>= _PDF_SHARD_MIN_PAGES pages) are split into _PDF_SHARD_PAGES page shards,
+# shards are converted in parallel by the conversion workers (_NUM_WORKERS > 0). 0 -> no split
+_PDF_SHARD_MIN_PAGES = 40
+_PDF_SHARD_PAGES = 10
+# Indexing (Solr, OpenSearch POSTs) threads, runs while the next document is converted
+_IO_WORKERS = 4
+# Max documents waiting to be indexed, conversion waits beyond this
+_IO_MAX_PENDING = 16
 
 """
 https://ds4sd.github.io/docling/faq/ question on offline
@@ -7,10 +7,17 @@
 """ coreutils module: Provides common utilities """
 
 import os
+import re
 import sys
 import random
-import json
 import typing
+import functools
+import copy
+import gzip
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
 import logging
 # Just importing logging can raise error on RotatingFileHandler
 from logging.handlers import RotatingFileHandler
@@ -19,31 +26,67 @@ from pathlib import Path
 from urllib.parse import urlencode as urlparse_encode
 import urllib3
 import requests
+import orjson
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from ftfy import fix_text
 import torch
 
 from coreconfigs import (_CHUNKTOKENIZER, _MODEL_PATH, _EMBED_DIM, _MAX_VECSEARCH_RESULTS, _FTBASE,
+                         _QRY_EMBED_CACHE_SIZE,
                          _FTPOST, _FTINDEX, _FTGET, _FTTLSVERIFY, _VECBASE, _CUDA_ARCHTYPE, _VECPOST,
                         _VECINDEX, _VECGET, _VECTLSVERIFY, _LM_MDL, _LM_MSG_TMPLT, _LM_MAX_INPUT_TKNS,
                         _LM_MAX_OUTPUT_TKNS, _REPETITION_PENALTY, _DO_SAMPLE, _TOP_K, _TOP_P,
-                        _MAX_LOG_BACKUP_FILES, _MAX_LOGFILESIZE, _GET_TIMEOUT, _POST_TIMEOUT)
+                        _MAX_LOG_BACKUP_FILES, _MAX_LOGFILESIZE, _GET_TIMEOUT, _POST_TIMEOUT,
+                        _HTTP_POOL_MAXSIZE, _HTTP_RETRIES, _LM_WARMUP_RUNS, _HF_OFFLINE,
+                        _LM_RESP_CACHE_SIZE, _LM_QUANTIZATION, _VEC_DATA_TYPE,
+                        _EMB_COMPILE, _VEC_GZIP_MIN_BYTES)
 
 # Import SentenceTransformer, transformers after setting the HF_HUB_CACHE location
 # If not HF will not use the pre-downloaded models in _MODEL_PATH location
 # Instead HF will download to the user local cache
 os.environ["TORCH_CUDA_ARCH_LIST"] = _CUDA_ARCHTYPE
 os.environ["HF_HUB_CACHE"] = _MODEL_PATH
+if _HF_OFFLINE:
+    os.environ["HF_HUB_OFFLINE"] = "1"
+# Set before the first CUDA allocation, expandable segments avoid fragmentation as the KV cache grows
+# expandable segments are not supported on Windows
+if sys.platform != "win32":
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+else:
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "max_split_size_mb:512")
+# TF32 matmuls. No cudnn.benchmark, docling models see a different input shape per page (re-tuning)
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
 import transformers
 from sentence_transformers import SentenceTransformer
 
 
+# Control characters removed by ftfy (tab, newlines, form feed are whitespace)
+_CTRL_RE = re.compile(r'[\x00-\x08\x0b\x0e-\x1f\x7f]+')
+
 def good_text(txt: str) -> str:
     """ Basic filters to cleanup text """
-    # Replace any windows special characters, mojibake ...
-    txt = fix_text(txt.replace("<missing-text>",'').replace('\n', ' '))
+    txt = txt.replace("<missing-text>", '')
+    if txt.isascii() and '&' not in txt and '\x1b' not in txt:
+        # ftfy fixes only change non-ascii text (or html entities, terminal escapes), strip the control characters only
+        txt = _CTRL_RE.sub('', txt)
+    else:
+        # Replace any windows special characters, mojibake ...
+        txt = fix_text(txt.replace('\n', ' '))
     txt = ' '.join(txt.split())
     return txt
 
+def quantize_embeddings(vecs) -> np.ndarray:
+    """ Embeddings for the VectorDB byte vectors (_VEC_DATA_TYPE = "byte")
+    Unit normalized and scaled to int8 [-127, 127]
+    """
+    vecs = np.asarray(vecs, dtype=np.float32)
+    norms = np.linalg.norm(vecs, axis=-1, keepdims=True)
+    return np.clip(np.rint(vecs / np.maximum(norms, 1e-12) * 127), -127, 127).astype(np.int8)
+
 def getlgr(lgrname: str, loglevel: int=logging.INFO):
     """ Function provides a logger
     Parameters
@@ -79,8 +122,23 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 class RequestsOps():
     """ For fulltext, vectorDB index GET/POST operations """
     def __init__(self, get_timeout: float=_GET_TIMEOUT, post_timeout: float=_POST_TIMEOUT):
-        """ Default post timeout is set to a higher value """
+        """ Default post timeout is set to a higher value
+        One session with a keep-alive connection pool, avoids TCP/TLS handshakes on every request
+        """
         self._req_session = requests.Session()
+        # POST is retried too, index posts are safe to repeat: bulk "create" with fixed ids and
+        # Solr _version_ checks turn a repeated write into a conflict, which the callers ignore
+        # 429 (throttled) honours the Retry-After header, failed responses are returned to the caller
+        retries = Retry(total=_HTTP_RETRIES, backoff_factor=0.1, status_forcelist=[429, 502, 503, 504],
+                        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"}, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=len(_FTBASE)+len(_VECBASE),
+                              pool_maxsize=_HTTP_POOL_MAXSIZE, max_retries=retries)
+        self._req_session.mount("http://", adapter)
+        self._req_session.mount("https://", adapter)
+        self._req_session.headers.update({"Content-type": "application/json", "Connection": "keep-alive"})
+        # Pick the hosts once per session, maximizes connection reuse
+        self._ftbase = random.choice(_FTBASE)
+        self._vecbase = random.choice(_VECBASE)
         self._get_timeout = get_timeout
         self._post_timeout = post_timeout
 
@@ -90,54 +148,50 @@ class RequestsOps():
             self._req_session.close()
 
     def requests_post(self, uri_type: typing.Literal["fulltext", "vec"], data: dict|str=None,
-                     headers: dict=None, params: dict=None, verify: bool=False):
+                     headers: dict=None, params: dict=None, verify: bool=False, timeout: float=None):
         """ TLS verify is set to False, set to true for certificate verification 
         uri_type = "fulltext" -> Solr Fulltext  or "vec" -> OpenSearch VectorDB 
         data = if dictionary, will be converted as json strings
+        timeout = None, uses the session post timeout
         """
-        # Only json data is accepted if headers is None, else specify the header
-        if data:
-            if isinstance(data, dict):
-                data = json.dumps(data)
-            if not headers:
-                headers = {"Content-type": "application/json"}
+        # Only json data is accepted if headers is None (session default), else specify the header
+        # orjson serializes numpy arrays (embeddings) directly, no python float lists
+        if isinstance(data, dict):
+            data = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
         if uri_type == "fulltext":
-            posturi = f"{random.choice(_FTBASE)}/{_FTINDEX}/{_FTPOST}"
+            posturi = f"{self._ftbase}/{_FTINDEX}/{_FTPOST}"
             verify = verify or _FTTLSVERIFY
         elif uri_type == "vec":
-            posturi = f"{random.choice(_VECBASE)}/{_VECINDEX}/{_VECPOST}"
+            posturi = f"{self._vecbase}/{_VECINDEX}/{_VECPOST}"
             verify = verify or _VECTLSVERIFY
+            # Embeddings as json text compress well, level 1 is fast
+            if _VEC_GZIP_MIN_BYTES and data and len(data) > _VEC_GZIP_MIN_BYTES:
+                if isinstance(data, str):
+                    data = data.encode()
+                data = gzip.compress(data, compresslevel=1)
+                headers = {**(headers or {}), "Content-Encoding": "gzip"}
         if params:
             posturi = f"{posturi}?{urlparse_encode(params, )}"
-        req = requests.Request('POST', posturi, data=data, headers=headers)
-        req_prepped = self._req_session.prepare_request(req)
-        resp = self._req_session.send(req_prepped,
-                                      timeout=self._post_timeout,
-                                      verify=verify)
+        resp = self._req_session.post(posturi, data=data, headers=headers,
+                                      timeout=timeout or self._post_timeout, verify=verify)
         return resp
 
     def requests_get(self, uri_type: typing.Literal["fulltext", "vec"], data: dict|str=None,
                      headers: dict=None, params: dict=None, verify: bool=False):
         """ uri_type = "fulltext" -> Solr Fulltext  or "vec" -> OpenSearch VectorDB """
-        if data:
-            if isinstance(data, dict):
-                data = json.dumps(data)
-            if not headers:
-                headers = {"Content-type": "application/json"}
+        if isinstance(data, dict):
+            data = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
         if uri_type == "fulltext":
-            geturi = f"{random.choice(_FTBASE)}/{_FTINDEX}/{_FTGET}"
+            geturi = f"{self._ftbase}/{_FTINDEX}/{_FTGET}"
             verify = verify or _FTTLSVERIFY
         elif uri_type == "vec":
-            geturi = f"{random.choice(_VECBASE)}/{_VECINDEX}/{_VECGET}"
+            geturi = f"{self._vecbase}/{_VECINDEX}/{_VECGET}"
             verify = verify or _VECTLSVERIFY
         if params:
             # safe + because the field list is passed with + in Solr. e.g. field1+field2
             geturi = f"{geturi}?{urlparse_encode(params, safe='+')}"
-        req = requests.Request('GET', geturi, data=data, headers=headers)
-        req_prepped = self._req_session.prepare_request(req)
-        resp = self._req_session.send(req_prepped,
-                                      timeout=self._get_timeout,
-                                      verify=verify)
+        resp = self._req_session.get(geturi, data=data, headers=headers,
+                                     timeout=self._get_timeout, verify=verify)
         return resp
 
 
@@ -147,7 +201,17 @@ class VectorEmbeddings():
         if mdl:
             self.emb_mdl = mdl
         else:
-            self.emb_mdl = SentenceTransformer(_CHUNKTOKENIZER)
+            # fp16 on GPU halves the memory bandwidth for the embeddings
+            if torch.cuda.is_available():
+                device, dtype = "cuda", torch.float16
+            else:
+                device, dtype = "cpu", torch.float32
+            self.emb_mdl = SentenceTransformer(_CHUNKTOKENIZER, device=device,
+                                               local_files_only=_HF_OFFLINE,
+                                               model_kwargs={"torch_dtype": dtype})
+            if _EMB_COMPILE:
+                # Only the transformer module, dynamic: batch size and sequence length vary per call
+                self.emb_mdl[0].auto_model = torch.compile(self.emb_mdl[0].auto_model, dynamic=True)
             ## Verify embedding dimension size before processing
             embeddings = self.emb_mdl.encode("Hello World")
             if _EMBED_DIM < embeddings.size:
@@ -157,30 +221,97 @@ class VectorEmbeddings():
                 sys.exit(1)
             else:
                 print("Embedding model ok.")
+            # Warmup, first encode after load triggers kernel selection (and the compile)
+            self.emb_mdl.encode(["warmup"]*4, batch_size=4)
+        # Search queries repeat often, cache the query embeddings keyed on the query text
+        self._qry_enc_cache = functools.lru_cache(maxsize=_QRY_EMBED_CACHE_SIZE)(self._qry_embeddings)
+
+    def _qry_embeddings(self, text: str) -> np.ndarray:
+        """ Query text embeddings as float32 (or int8, byte vectors) array, read-only, it is shared by the cache """
+        with torch.inference_mode():
+            embeddings = self.emb_mdl.encode(text, convert_to_numpy=True, batch_size=1)
+        if _VEC_DATA_TYPE == "byte":
+            embeddings = quantize_embeddings(embeddings)
+        else:
+            embeddings = embeddings.astype(np.float32, copy=False)
+        embeddings.flags.writeable = False
+        return embeddings
 
     def get_qry_for_similar_texts(self, text: str, max_results: int=_MAX_VECSEARCH_RESULTS) -> dict:
         """
         1. Generate text embedding on the input text
         2. Compare similarity against vectorDB and get texts similar to the input text.
         """
-        embeddings = self.emb_mdl.encode(text)
-        embed_str = embeddings.tolist()
+        embeddings = self._qry_enc_cache(text)
 
-        qrydct = {"_source": "false",
+        qrydct = {"_source": False,
                   "fields": ["docchunk", "docpath"],
-                  "query": {"knn": {"chunkvec": {"vector": embed_str, "k": max_results }}}
+                  "query": {"knn": {"chunkvec": {"vector": embeddings, "k": max_results }}}
                  }
         return qrydct
 
 
+class EmbeddingsCache():
+    """ Persistent chunk text -> embedding cache (SQLite)
+    Reindexed documents, repeated chunks (headers, footers...) are not encoded again
+    Embeddings are stored as float16 bytes, key is sha256 of the model name + chunk text
+    """
+    def __init__(self, dbpath: str, mdl_name: str=_CHUNKTOKENIZER):
+        self._mdl_name = mdl_name
+        # Used by the io pool threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(dbpath, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embcache (key BLOB PRIMARY KEY, vec BLOB)")
+        self._conn.commit()
+
+    def keys(self, texts: list) -> list:
+        """ Cache keys for the texts """
+        return [hashlib.sha256(f"{self._mdl_name}\0{txt}".encode()).digest() for txt in texts]
+
+    def get(self, keys: list) -> dict:
+        """ Returns key -> embedding (float32 array) for the keys found in the cache """
+        found = {}
+        with self._lock:
+            # Limit the number of sql variables per query
+            for i in range(0, len(keys), 500):
+                part = keys[i:i+500]
+                qry = f"SELECT key, vec FROM embcache WHERE key IN ({','.join('?'*len(part))})"
+                for key, vec in self._conn.execute(qry, part):
+                    found[key] = np.frombuffer(vec, dtype=np.float16).astype(np.float32)
+        return found
+
+    def put(self, keys: list, vecs) -> None:
+        """ Save the embeddings, existing keys are ignored """
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO embcache VALUES (?, ?)",
+                                   ((key, np.asarray(vec, dtype=np.float16).tobytes())
+                                    for key, vec in zip(keys, vecs)))
+            self._conn.commit()
+
+    def close(self):
+        """ Close the database connection """
+        with self._lock:
+            self._conn.close()
+
+
 class LMOps():
     """For Language Model generation/summarization """
     def __init__(self):
         """ Penalize repetitions - 1.1, default temp is 6. Less randomness, stick to existing document texts """
+        mdl_kwargs = {"local_files_only": _HF_OFFLINE}
+        if _LM_QUANTIZATION == "nf4":
+            mdl_kwargs["quantization_config"] = transformers.BitsAndBytesConfig(
+                                                    load_in_4bit=True,
+                                                    bnb_4bit_quant_type="nf4",
+                                                    bnb_4bit_compute_dtype=torch.bfloat16,
+                                                    bnb_4bit_use_double_quant=True)
+        elif _LM_QUANTIZATION == "int8":
+            mdl_kwargs["quantization_config"] = transformers.BitsAndBytesConfig(load_in_8bit=True)
         self.pipeline = transformers.pipeline("text-generation",
                                               model=_LM_MDL,
                                               torch_dtype=torch.bfloat16,
                                               device_map="auto",
+                                              model_kwargs=mdl_kwargs,
                                              )
         self.gconfigdct = self.pipeline.model.generation_config.to_dict()
         self.gconfigdct["max_new_tokens"] = _LM_MAX_OUTPUT_TKNS
@@ -189,22 +320,70 @@ class LMOps():
         self.gconfigdct["top_p"] = _TOP_P
         self.gconfigdct["repetition_penalty"] = _REPETITION_PENALTY
         self.gconfigdct["pad_token_id"] = self.pipeline.model.config.eos_token_id
+        self.gconfigdct["use_cache"] = True
+        # Built once, copied per request with the request temperature
+        self._base_gconfig = transformers.GenerationConfig(**self.gconfigdct)
         self._msg_template = _LM_MSG_TMPLT
+        # LRU, hashed query/cache key -> response
+        self._resp_cache = OrderedDict()
+        self._warmup()
+
+    def _warmup(self):
+        """ Run few short generations, the first user query then behaves like the Nth query """
+        with torch.inference_mode():
+            for _ in range(_LM_WARMUP_RUNS):
+                self.pipeline("warmup", max_new_tokens=8, do_sample=False,
+                              pad_token_id=self.gconfigdct["pad_token_id"])
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            torch.cuda.empty_cache()
+
+    @staticmethod
+    def _resp_cache_key(cache_key: str, temp: int) -> bytes:
+        """ Fixed size key for the response cache """
+        return hashlib.blake2b(f"{temp}|{cache_key}".encode(), digest_size=16).digest()
 
-    def mdl_response(self, qry: str, temp: int=6) -> str:
+    def cached_response(self, cache_key: str, temp: int=6) -> str|None:
+        """ Returns the cached response for the cache_key, None if not in cache """
+        if temp < 1 or temp > 9:
+            temp = 6
+        key = self._resp_cache_key(cache_key, temp)
+        res = self._resp_cache.get(key)
+        if res is not None:
+            self._resp_cache.move_to_end(key)
+        return res
+
+    def mdl_response(self, qry: str, temp: int=6, cache_key: str=None) -> str:
         """ Function returns the answer from the Language Model
         Invoked with the context (RAG), qry is with context
+        cache_key: response is cached on the key, defaults to qry
         """
         if temp < 1 or temp > 9:
             temp = 6
-        # 10 tokens less than the max tokens
-        if len(qry_texts_lst := qry.split()) >= (maxlen := _LM_MAX_INPUT_TKNS-10):
-            qry = ' '.join(qry_texts_lst[:maxlen])
+        cache_key = cache_key or qry
+        if (res := self.cached_response(cache_key, temp)) is not None:
+            return res
+        # 10 tokens less than the max tokens, truncate on tokens (not words)
+        tkn_ids = self.pipeline.tokenizer(qry, add_special_tokens=False)["input_ids"]
+        if len(tkn_ids) > (maxlen := _LM_MAX_INPUT_TKNS-10):
+            qry = self.pipeline.tokenizer.decode(tkn_ids[:maxlen], skip_special_tokens=True)
         self._msg_template[1]['content'] = qry
         prompt = self.pipeline.tokenizer.apply_chat_template(self._msg_template, tokenize=False,
                                                              add_generation_prompt=True)
-        self.gconfigdct["temperature"] = temp/10
-        gconfig = transformers.GenerationConfig(**self.gconfigdct)
-        outputs = self.pipeline(prompt, generation_config=gconfig)
+        gconfig = copy.copy(self._base_gconfig)
+        if temp <= 1:
+            # Lowest temperature, deterministic greedy decoding skips sampling
+            gconfig.do_sample = False
+            gconfig.num_beams = 1
+            gconfig.temperature = None
+            gconfig.top_k = None
+            gconfig.top_p = None
+        else:
+            gconfig.temperature = temp/10
+        with torch.inference_mode():
+            outputs = self.pipeline(prompt, generation_config=gconfig)
         res = outputs[0]["generated_text"].split("<|im_start|>assistant\n")[1]
+        self._resp_cache[self._resp_cache_key(cache_key, temp)] = res
+        if len(self._resp_cache) > _LM_RESP_CACHE_SIZE:
+            self._resp_cache.popitem(last=False)
         return res
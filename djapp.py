@@ -7,9 +7,13 @@
 """ Document search single page Django app """
 
 import os
+import re
 import time
+import functools
+import threading
 from datetime import datetime
-from collections import OrderedDict
+from collections import defaultdict
+import orjson
 import markdown
 from humanize import precisedelta
 
@@ -19,6 +23,38 @@ from django.shortcuts import render
 
 from coreutils import getlgr, RequestsOps, LMOps, VectorEmbeddings
 
+# Translation tables, remove the characters in a single pass
+_PUNCT_TABLE = str.maketrans('', '', '?,.')
+_QUOTE_TABLE = str.maketrans('', '', '?,."')
+_BOOL_OPS = frozenset({"AND", "OR", "NOT"})
+_BOOL_OPS_RE = re.compile(r'\b(?:AND|OR|NOT)\b')
+
+# stop and question words, borrowed from NLTK
+_STOP_WORDS = frozenset({'i', 'me', 'my', 'myself', 'we', 'our', 'ours',
+    'ourselves', 'you', "you're", "you've", "you'll", "you'd", 'your', 'yours', 'yourself', 
+    'yourselves', 'he', 'him', 'his', 'himself', 'she', "she's", 'her', 'hers', 'herself', 
+    'it', "it's", 'its', 'itself', 'they', 'them', 'their', 'theirs', 'themselves',
+     'this', 'that', "that'll", 'these', 'those', 'am', 'is', 'are', 'did', 'doing',
+     'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'having', 'do', 'does',
+     'a', 'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'until', 'while', 'of', 'at',
+    'with', 'about', 'against', 'between', 'into', 'through', 'during', 'before', 'after', 'above',
+    'from', 'up', 'down', 'in', 'out', 'on', 'off', 'over', 'under', 'again', 'further', 'then',
+    'here', 'there',  'all', 'any', 'both', 'each', 'few', 'more', 'most',  'by', 'for', 'once',
+    'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 
+    's', 't', 'can', 'will', 'just', 'don', "don't", 'should', "should've", 'now', 'below', 'to',
+     'ain', 'aren', "aren't", 'couldn', "couldn't", 'didn', "didn't", 'doesn', "doesn't", 
+    'hadn', "hadn't", 'hasn', "hasn't", 'haven', "haven't", 'isn', "isn't", 'ma', 'mightn',
+     "mightn't", 'mustn', "mustn't", 'needn', "needn't", 'shan', "shan't", 'shouldn', "shouldn't",
+    'wasn', "wasn't", 'weren', "weren't", 'won', "won't", 'wouldn', "wouldn't"})
+_Q_WORDS = frozenset({'what', 'which', 'who', 'whom', 'when', 'where', 'whose', 'why', 'how'})
+_ADDL_Q_WORDS = frozenset({'explain', 'describe', 'elaborate', 'summarize', 'examine', 'evaluate',
+                           'analyze', 'clarify', 'diagnose', 'assess' })
+# stop and question words are skipped in the search terms, single membership test
+_SKIP_WORDS = _STOP_WORDS | _Q_WORDS
+
+# Markdown converter is built once (extensions, regexes), reset before each conversion
+_MD = markdown.Markdown(extensions=['fenced_code', 'tables'])
+
 
 def fmt_ftresults(results: str, fltr_inp: str) -> (list[tuple], int):
     """ Formats BM25 search results for HTML display
@@ -28,56 +64,110 @@ def fmt_ftresults(results: str, fltr_inp: str) -> (list[tuple], int):
     """
     doclst = []
     doccntr = None
+    # NOT, AND, OR has special meaning in Solr search, remove them for the filtered text
+    # Remove " from the input query string e.g. searching for "all good work" -> next to each other
+    # remove anything after ~, e.g. "apache lucene"~5 means within 5 words of each other
+    inpl = _BOOL_OPS_RE.sub('', fltr_inp).translate(_QUOTE_TABLE).lower().split('~')[0].split()
+    # Left strip +- from the input query string + -  has special meaning to must include/exclude the term
+    # L/R strip (), grouping clauses
+    cleaned_terms = [term.lstrip('(+-').rstrip(')') for term in inpl]
+    term_set = frozenset(cleaned_terms)
     for doccntr, item in enumerate(results["response"]["docs"], 1):
         ## extract words around the search terms, ignore ?,.
         # e.g. quality. or quality, or quality?
-        txtlst = item["doctext"].replace('?','').replace(',','').replace('.','').split()
-
-        # NOT, AND, OR has special meaning in Solr search, remove them for the filtered text
-        inpl = fltr_inp.replace("AND", '').replace("OR", '').replace("NOT", '')
-
-        # Remove " from the input query string e.g. searching for "all good work" -> next to each other
-        # remove anything after ~, e.g. "apache lucene"~5 means within 5 words of each other
-        inpl = inpl.replace('?','').replace(',','').replace('.','').replace('"','').lower().split('~')[0].split()
+        txtlst = item["doctext"].translate(_PUNCT_TABLE).split()
 
         # Get the input search terms, indexes the terms in the received fulltext in sorted order
+        # word -> positions map, one pass over the text, dict lookup per term
+        wrdpos = defaultdict(list)
+        for i, wrd in enumerate(txtlst):
+            wrdpos[wrd.lower()].append(i)
         indxs = []
-        # Left strip +- from the input query string + -  has special meaning to must include/exclude the term
-        # L/R strip (), grouping clauses
-        for term in inpl:
-            indxs +=  [i for i, x in enumerate(txtlst) if x.lower()==term.lstrip('(').lstrip('+').lstrip('-').rstrip(')')]
-        indxs = list(OrderedDict.fromkeys(indxs))
+        for term in cleaned_terms:
+            indxs.extend(wrdpos.get(term, ()))
+        indxs = sorted(set(indxs))
         maxind = len(txtlst) -1
-        #texts = []
-        txt = ''
+        windows = []
+        wrdcnt = 0
         # get 5 words before and after the search terms
         # show ~100 words for each document
-        for cntr, ind in enumerate(indxs):
+        for ind in indxs:
             if (lft:=ind -5) <= 0:
                 lft = 0
             if (rgt:=ind +5) > maxind:
                 rgt = maxind
-            try:
-                # Add emsp after each sentence chunk for visual separation
-                txt = f"{txt} {' '.join(txtlst[lft:rgt])} &emsp;"
-            except IndexError:
-                pass
-            if cntr > 9:
-                txt = f"{txt} ..."
+            # Sorted indexes, merge overlapping windows, no repeated words for terms close to each other
+            if windows and lft <= windows[-1][1]:
+                wrdcnt += rgt - windows[-1][1]
+                windows[-1][1] = rgt
+            else:
+                wrdcnt += rgt - lft
+                windows.append([lft, rgt])
+            if wrdcnt > 100:
                 break
+        # Add emsp after each sentence chunk for visual separation
+        chunks = [f"{' '.join(txtlst[lft:rgt])} &emsp;" for lft, rgt in windows]
+        if wrdcnt > 100:
+            chunks.append("...")
         # If we are not able to get texts around the search terms, show few chars from the document
-        txt = txt or item["doctext"][:500]
-        txtlst = txt.split()
-        # Iterate the texts for all search terms, convert the terms to <span> for highlighting
-        for term in inpl:
-            for cntr, each in enumerate(txtlst):
-                if each.lower() == term.lstrip('+').lstrip('-'):
-                    txtlst[cntr] = f'<span class="srchterm">{each}</span>'
+        txt = ' '.join(chunks) or item["doctext"][:500]
+        # Single pass over the texts, convert the search terms to <span> for highlighting
+        txtlst = [f'<span class="srchterm">{each}</span>' if each.lower() in term_set else each
+                  for each in txt.split()]
         # document ts is stored as int. Convert to readable format
         mtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(item["docts"]))
         doclst.append((item["docpath"], mtime, ' '.join(txtlst)))
     return doclst, doccntr
 
+@functools.cache
+def get_requestsession() -> RequestsOps:
+    """ Shared requests session, created on the first call """
+    return RequestsOps()
+
+@functools.cache
+def get_emdb() -> VectorEmbeddings:
+    """ Embedding model, loaded on the first call """
+    return VectorEmbeddings()
+
+_LMDL_LOCK = threading.Lock()
+# LMOps once loaded, _LMDL_FAILED if the load failed
+_LMDL = None
+_LMDL_FAILED = object()
+
+def load_lmdl() -> None:
+    """ Loads the language model once. Started in a background thread at startup
+    A failed load is logged and not retried, questions are answered without the AI summary
+    """
+    global _LMDL
+    with _LMDL_LOCK:
+        if _LMDL is not None:
+            return
+        try:
+            _LMDL = LMOps()
+        except Exception as exc:
+            _lgrdj.error("Unable to load the language model, AI summary is disabled")
+            _lgrdj.error(exc)
+            _LMDL = _LMDL_FAILED
+
+def get_lmdl() -> LMOps | None:
+    """ Language model, None if the load failed
+    Lock, a request during the background load waits for it instead of loading a second model
+    """
+    load_lmdl()
+    return None if _LMDL is _LMDL_FAILED else _LMDL
+
+def similar_texts(qrydata: dict, top_docs: list):
+    """ Query VectorDB (OpenSearch) for texts similar to the input
+    qrydata: kNN query on the input (get_qry_for_similar_texts)
+    The nearest chunks are filtered on the top BM25 documents, only the top 10 chunks are returned
+    """
+    # "post_filter": {"bool": {"should": [{"match_phrase": { "docpath": "file1"}},
+                         # {"match_phrase": { "docpath": "file2"}}]}}
+    qrydata["post_filter"] = {"bool": {"should": [{"match_phrase": {"docpath": docpath}} for docpath in top_docs]}}
+    qrydata["size"] = 10
+    # Response has only the hit fields (docchunk, docpath), no _id, _index, _score, totals
+    return get_requestsession().requests_get("vec", data=qrydata, params={"filter_path": "hits.hits.fields"})
+
 def req_docs(inp: str) -> (list[tuple], str, str, str):
     """ Accepts user input, query Solr/Opensearch for fulltext/semantic search texts 
     Returns: List of documents: based on query terms
@@ -85,57 +175,34 @@ def req_docs(inp: str) -> (list[tuple], str, str, str):
              desc: No of documents found based on BM25 search
              err: In case of errors, "error description" else None
     """
-    # stop and question words, borrowed from NLTK
-    stp_words = {'i', 'me', 'my', 'myself', 'we', 'our', 'ours',
-    'ourselves', 'you', "you're", "you've", "you'll", "you'd", 'your', 'yours', 'yourself', 
-    'yourselves', 'he', 'him', 'his', 'himself', 'she', "she's", 'her', 'hers', 'herself', 
-    'it', "it's", 'its', 'itself', 'they', 'them', 'their', 'theirs', 'themselves',
-     'this', 'that', "that'll", 'these', 'those', 'am', 'is', 'are', 'did', 'doing',
-     'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'having', 'do', 'does',
-     'a', 'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'until', 'while', 'of', 'at',
-    'with', 'about', 'against', 'between', 'into', 'through', 'during', 'before', 'after', 'above',
-    'from', 'up', 'down', 'in', 'out', 'on', 'off', 'over', 'under', 'again', 'further', 'then',
-    'here', 'there',  'all', 'any', 'both', 'each', 'few', 'more', 'most',  'by', 'for', 'once',
-    'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 
-    's', 't', 'can', 'will', 'just', 'don', "don't", 'should', "should've", 'now', 'below', 'to',
-     'ain', 'aren', "aren't", 'couldn', "couldn't", 'didn', "didn't", 'doesn', "doesn't", 
-    'hadn', "hadn't", 'hasn', "hasn't", 'haven', "haven't", 'isn', "isn't", 'ma', 'mightn',
-     "mightn't", 'mustn', "mustn't", 'needn', "needn't", 'shan', "shan't", 'shouldn', "shouldn't",
-    'wasn', "wasn't", 'weren', "weren't", 'won', "won't", 'wouldn', "wouldn't"}
-    q_words = {'what', 'which', 'who', 'whom', 'when', 'where', 'whose', 'why', 'how'}
-    addl_q_words = {'explain', 'describe', 'elaborate', 'summarize', 'examine', 'evaluate',
-                    'analyze', 'clarify', 'diagnose', 'assess' }
-
     err = None
     descr = None
     ft_result = None
+    cached_resp = None
     # If there is a question, enable AI summary
     ai_summary = bool(inp.endswith('?'))
 
-    linp = ""
-    for cntr, item in enumerate(inp.split()):
-        lwitem = item.lower()
-        # NOT, AND, OR has special meaning in Solr search, below if order is important
-        # if the first word is "question like" then create AI summary, .e.g. describe, explain
-        if cntr==0 and (lwitem in q_words or lwitem in addl_q_words):
-            ai_summary = True
-        elif item in ("AND", "OR", "NOT"):
-            linp = f"{linp} {item}"
-        # ignore stop and question words
-        elif lwitem not in q_words and lwitem not in stp_words:
-            linp = f"{linp} {lwitem}"
+    tokens = inp.split()
+    # if the first word is "question like" then create AI summary, .e.g. describe, explain
+    if tokens and ((lwitem := tokens[0].lower()) in _Q_WORDS or lwitem in _ADDL_Q_WORDS):
+        ai_summary = True
+        tokens = tokens[1:]
+    # NOT, AND, OR has special meaning in Solr search, keep them as is, check them first
+    # ignore stop and question words
+    linp = ' '.join([item if item in _BOOL_OPS else item.lower() for item in tokens
+                     if item in _BOOL_OPS or item.lower() not in _SKIP_WORDS])
 
     if linp:
         params = {'q':f"{linp}", "fl":"doctext+docpath+docts"}
         try:
-            resp = requestsession.requests_get("fulltext", params=params)
+            resp = get_requestsession().requests_get("fulltext", params=params)
         except Exception as exc:
             _lgrdj.error("Unable to search documents")
             _lgrdj.error(exc)
             err = "Unable to search documents. Check the logs files."
         else:
             if resp.ok:
-                results = resp.json()
+                results = orjson.loads(resp.content)
                 if results['response']['numFound'] > 0:
                     ft_result, doccnt = fmt_ftresults(results, linp)
                     descr = f"Documents found:{doccnt}"
@@ -151,22 +218,27 @@ def req_docs(inp: str) -> (list[tuple], str, str, str):
     # check if question is asked, use AI to summarize
     # Generate summary only if the BM25 search has results
     ai_summary = ai_summary and ft_result
+    # Language model is not available (load failed), show the BM25 results only
+    if ai_summary and (lmdl := get_lmdl()) is None:
+        ai_summary = False
     if ai_summary:
-        ## Get similar texts from VectorDB (OpenSearch)
         # replace " - grouped search terms
-        btime = datetime.now()
         # text stored in vectorDB is lowercase text
         linp = linp.replace('"','')
+        # Same question on the same top 10 BM25 documents, reuse the earlier summary
+        cache_key = f"{linp}|{'|'.join(sorted(item[0] for item in ft_result[:10]))}"
+        if (cached_resp := lmdl.cached_response(cache_key)) is not None:
+            _lgrdj.info("AI summary(cached):%s", linp)
+            ai_summary = _MD.reset().convert(cached_resp)
+    if ai_summary and cached_resp is None:
+        ## Get similar texts from VectorDB (OpenSearch)
+        # Only if the BM25 search has results and the summary is not cached
+        btime = datetime.now()
         _lgrdj.info("AI summary:%s", linp)
-        qrydata = emdb.get_qry_for_similar_texts(linp)
-        # Get the top 10 hits(files) from the BM25 and filter vectorDB on those file chunks only
-        # "post_filter": {"bool": {"should": [{"match_phrase": { "docpath": "file1"}},
-                             # {"match_phrase": { "docpath": "file2"}}]}}
-        should_lst = [{"match_phrase": {"docpath": item[0]}}
-                      for cntr, item in enumerate(ft_result) if cntr <10]
-        qrydata["post_filter"] = {"bool": {"should": should_lst}}
+        # Get the top 10 hits(files) from the BM25 and use the vectorDB chunks of those files only
+        top_docs = [item[0] for item in ft_result[:10]]
         try:
-            resp = requestsession.requests_get("vec", data=qrydata)
+            resp = similar_texts(get_emdb().get_qry_for_similar_texts(linp), top_docs)
             _lgrdj.info("VectorDB: %s", precisedelta(datetime.now() - btime, minimum_unit="milliseconds"))
         except Exception as exc:
             # In case of errors, ignore ai_summary
@@ -174,15 +246,18 @@ def req_docs(inp: str) -> (list[tuple], str, str, str):
             _lgrdj.error(exc)
             ai_summary = False
         else:
-            if resp.ok and resp.json()["hits"]["total"]["value"] > 0:
+            hits = []
+            if resp.ok:
+                # filter_path, no hits returns an empty json
+                hits = orjson.loads(resp.content).get("hits", {}).get("hits", [])
+            if hits:
                 # Add the context to the input query
                 query_cntxt = f"{linp} "
-                query_cntxt += ' '.join((each["fields"]["docchunk"][0]
-                                      for each in resp.json()["hits"]["hits"]))
-                ai_summary = markdown.markdown(lmdl.mdl_response(query_cntxt))
+                query_cntxt += ' '.join((each["fields"]["docchunk"][0] for each in hits))
+                ai_summary = _MD.reset().convert(lmdl.mdl_response(query_cntxt, cache_key=cache_key))
                 _lgrdj.info("%s took %s", linp, precisedelta(datetime.now() - btime))
             else:
-                _lgrdj.error("Unable to get similar texts for %s: %s", linp, resp.json())
+                _lgrdj.error("Unable to get similar texts for %s: %s", linp, resp.text)
                 ai_summary = False
     return ft_result, ai_summary, descr, err
 
@@ -243,9 +318,10 @@ urlpatterns = (
 
 if __name__ == "__main__":
     _lgrdj = getlgr("searchdocsUI")
-    requestsession = RequestsOps()
-    lmdl = LMOps()
-    emdb = VectorEmbeddings()
+    get_requestsession()
+    get_emdb()
+    # Language model loads in the background, BM25 searches are served meanwhile
+    threading.Thread(target=load_lmdl, daemon=True).start()
     from django.core.management import execute_from_command_line
     args = ['searchdocuments', 'runserver', '0.0.0.0:8000', '--noreload', '--skip-checks', '--nothreading', '--insecure' ]
     execute_from_command_line(args)
@@ -13,21 +13,34 @@
 import os
 import sys
 import time
-import json
+import threading
+import functools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from io import BytesIO
 from pathlib import Path
 from datetime import datetime
 import argparse
+import orjson
+import numpy as np
 from humanize import precisedelta
 
-from coreconfigs import _VECINDEX, _MODEL_PATH, _MAXCHNKLEN, _CHUNKTOKENIZER, _CUDA_ARCHTYPE
+from coreconfigs import _VECINDEX, _MODEL_PATH, _MAXCHNKLEN, _CHUNKTOKENIZER, _CUDA_ARCHTYPE, _HF_OFFLINE
 from coreconfigs import (_NUM_THREADS, _DO_OCR, _OCR_LANG, _PAGE_IMAGES, _PICTURE_IMAGES,
-                        _TABLE_STRUCTURE, _CELL_MATCHING, _PDF_BACKEND)
+                        _TABLE_STRUCTURE, _CELL_MATCHING, _PDF_BACKEND, _EMBED_BATCH_SIZE,
+                        _FT_BATCH_DOCS, _FT_BATCH_BYTES, _FT_POST_TIMEOUT, _POST_TIMEOUT,
+                        _IO_WORKERS, _IO_MAX_PENDING,
+                        _EMB_CACHE_DB, _VEC_BULK_DOCS, _VEC_BULK_BYTES, _VEC_DATA_TYPE,
+                        _NUM_WORKERS, _PDF_SHARD_MIN_PAGES, _PDF_SHARD_PAGES)
 
 # docling modules uses SentenceTransformer
 # If HF_HUB_CACHE location is not set then HF will not use the pre-downloaded models in _MODEL_PATH location
 # Instead HF will download to the user local cache
 os.environ["TORCH_CUDA_ARCH_LIST"] = _CUDA_ARCHTYPE
 os.environ["HF_HUB_CACHE"] = _MODEL_PATH
+if _HF_OFFLINE:
+    os.environ["HF_HUB_OFFLINE"] = "1"
 
 from docling.datamodel.base_models import InputFormat, DocumentStream
 from docling.backend.docling_parse_v2_backend import DoclingParseV2DocumentBackend
@@ -38,21 +51,37 @@ from docling.datamodel.pipeline_options import (PdfPipelineOptions,
                                                 TableFormerMode)
 from docling.document_converter import DocumentConverter, PdfFormatOption
 from docling.chunking import HybridChunker
+from docling.utils.utils import create_file_hash
+import pypdfium2 as pdfium
+import torch
+from transformers import AutoTokenizer
 
-from coreutils import RequestsOps, getlgr, VectorEmbeddings, good_text
+# CPU ops (ocr, layout on cpu, encode without cuda) use _NUM_THREADS, not all cores per process
+torch.set_num_threads(_NUM_THREADS)
+torch.set_num_interop_threads(2)
+
+from coreutils import (RequestsOps, getlgr, VectorEmbeddings, EmbeddingsCache, good_text,
+                       quantize_embeddings)
 
 class DoclingOps(VectorEmbeddings):
     """ Docling operations on supported file types
     Extract text, contexts from documents
     """
-    def __init__(self):
-        """ Use docling to extract text, contexts from pdf document """
-        super().__init__()
-        self._chunker = HybridChunker(tokenizer=_CHUNKTOKENIZER, max_tokens=_MAXCHNKLEN)
+    def __init__(self, vecmdl: bool=True):
+        """ Use docling to extract text, contexts from pdf document
+        vecmdl=False: conversion only (conversion pool workers), embedding model is not loaded
+        """
+        if vecmdl:
+            super().__init__()
+        # Fast (rust) tokenizer, the chunker counts tokens of every document item
+        # merge_peers: merges the small consecutive chunks with the same headings
+        tokenizer = AutoTokenizer.from_pretrained(_CHUNKTOKENIZER, use_fast=True, local_files_only=_HF_OFFLINE)
+        self._chunker = HybridChunker(tokenizer=tokenizer, max_tokens=_MAXCHNKLEN, merge_peers=True)
         self.doc = None
         self.fulltext = None
         self._docconv = None
-        self._chunk_iter = None
+        self.chunks = []
+        self._embcache = EmbeddingsCache(_EMB_CACHE_DB) if _EMB_CACHE_DB and vecmdl else None
 
         self._ploptions = PdfPipelineOptions()
         self._ploptions.artifacts_path = _MODEL_PATH
@@ -81,10 +110,11 @@ class DoclingOps(VectorEmbeddings):
             },
         )
 
-    def convert_doc(self, docpath, stream=None) -> None:
+    def convert_doc(self, docpath, stream=None, need_fulltext: bool=True, need_chunks: bool=True) -> None:
         """ Accepts a Path or BytesIO object. Extracts all texts from the doc
         Docling doesn't have a feature to extract text by pages. Requires custom code.
-        Iterates the document chunks (with context) and sets the chunked iterator
+        Iterates the document chunks (with context) and sets the chunk texts list
+        need_fulltext, need_chunks=False: skips the document traversal, fulltext "" or chunks []
         """
         if stream:
             # If docpath is str, and not a Path
@@ -95,39 +125,123 @@ class DoclingOps(VectorEmbeddings):
             self.doc = self._docconv.convert(DocumentStream(name=fname, stream=stream)).document
         else:
             self.doc = self._docconv.convert(docpath).document
-        self.fulltext = good_text(self.doc.export_to_text())
-        self._chunk_iter = (good_text(self._chunker.serialize(chunk=chunk).replace('\n', ' '))
-                                for chunk in self._chunker.chunk(self.doc)
-                           )
-
-    def get_embeddings_for_vdb(self, docpath) -> dict:
-        """ Generator object to create chunktext, embedding """        
-        for txtchunk in self._chunk_iter:
-            # sometimes the chunker creates small chunks e.g. header text only, ignore them
-            if len(txtchunk.split()) > 5:
-                # Convert text chunks to lower case, generate and store the embeddings with chunks
-                txt = txtchunk.lower()
-                embeddings = self.emb_mdl.encode(txt)
-                embed_str = embeddings.tolist()
-                # Required json format for OpenSearch to index
-                # {"chunkvec": <vector>, "docchunk": "<txt>", "docpath": "<fullfilepath>" }
-                dct = {"chunkvec": embed_str,
-                       "docchunk": txt,
-                       "docpath":docpath.as_posix()
-                      }
-                yield dct
-
-
-def index_fulltext(flname, overwrite_on_dup='n', tlsverify=False) -> None:
-    """Index full text into Solr, if OpenSearch is used instead of Solr, make changes to this function
+        self.fulltext = good_text(self.doc.export_to_text()) if need_fulltext else ""
+        # sometimes the chunker creates small chunks e.g. header text only, skip them before the cleanup
+        self.chunks = [good_text(raw) for chunk in self._chunker.chunk(self.doc)
+                       if len((raw := self._chunker.serialize(chunk=chunk)).split()) > 5] if need_chunks else []
+
+    def embcache_close(self) -> None:
+        """ Make sure to close the embeddings cache """
+        if self._embcache:
+            self._embcache.close()
+
+    def get_embeddings_for_vdb(self, docpath: str, chunks: list) -> dict:
+        """ Generator object to create chunktext, embedding
+        docpath: file path (posix), chunks: chunk texts of the document, see convert_doc
+        All chunks of the document are encoded in batches, the model sorts them by length (less padding)
+        """
+        # sometimes the chunker creates small chunks e.g. header text only, ignore them
+        # Convert text chunks to lower case, generate and store the embeddings with chunks
+        texts = [txtchunk.lower() for txtchunk in chunks if len(txtchunk.split()) > 5]
+        if not texts:
+            return
+        if self._embcache:
+            keys = self._embcache.keys(texts)
+            cached = self._embcache.get(keys)
+        else:
+            keys = [None] * len(texts)
+            cached = {}
+        # One (chunks, dim) float32 array for the document, rows from the cache or the model
+        vecs = np.empty((len(texts), self.emb_mdl.get_sentence_embedding_dimension()), dtype=np.float32)
+        misses = []
+        for i, key in enumerate(keys):
+            if key in cached:
+                vecs[i] = cached[key]
+            else:
+                misses.append(i)
+        # Encode only the chunks not in the cache
+        if misses:
+            with torch.inference_mode():
+                missed_vecs = self.emb_mdl.encode([texts[i] for i in misses], batch_size=_EMBED_BATCH_SIZE,
+                                                  convert_to_numpy=True, show_progress_bar=False)
+            vecs[misses] = missed_vecs
+            if self._embcache:
+                self._embcache.put([keys[i] for i in misses], missed_vecs)
+        if _VEC_DATA_TYPE == "byte":
+            vecs = quantize_embeddings(vecs)
+        for txt, embeddings in zip(texts, vecs):
+            # Required json format for OpenSearch to index
+            # {"chunkvec": <vector>, "docchunk": "<txt>", "docpath": "<fullfilepath>" }
+            # numpy row view, serialized by orjson (OPT_SERIALIZE_NUMPY) without a python list copy
+            dct = {"chunkvec": embeddings,
+                   "docchunk": txt,
+                   "docpath": docpath
+                  }
+            yield dct
+
+
+# Full text documents are buffered, one POST indexes a batch of documents
+# Buffer is shared by the io pool threads
+_ft_buffer = []
+_ft_buffer_bytes = 0
+_ft_lock = threading.Lock()
+
+def is_indexed(dochash: int, fulltext='y', embeddings='y', tlsverify=False) -> bool:
+    """ Checks if the document is already in the fulltext and/or the vectorDB index
+    dochash : document hash (docling binary_hash), the Solr id and the chunk id prefix
+    On errors the document is treated as not indexed, and processed as usual
+    """
+    try:
+        if fulltext == 'y':
+            resp = requestsession.requests_get("fulltext", params={"q": f"id:{dochash}", "rows": 0},
+                                               verify=tlsverify)
+            if not resp.ok or orjson.loads(resp.content)["response"]["numFound"] == 0:
+                return False
+        if embeddings == 'y':
+            # id of the first chunk
+            resp = requestsession.requests_get("vec", data={"size": 0, "query": {"ids": {"values": [f"{dochash}0"]}}},
+                                               verify=tlsverify)
+            if not resp.ok or orjson.loads(resp.content)["hits"]["total"]["value"] == 0:
+                return False
+    except Exception as exc:
+        _lgrm.error(exc)
+        return False
+    return True
+
+def index_fulltext(docpath: str, docts: float, dochash: int, doctext: str,
+                   overwrite_on_dup='n', tlsverify=False) -> None:
+    """Buffer the full text for Solr indexing, indexes the buffer once it is full
+    If OpenSearch is used instead of Solr, make changes to this function and flush_fulltext
     Inputs
     --------
-    flname : Path object
+    docpath : file path (posix), docts: file mtime
+    dochash : document hash (docling binary_hash), used as the id
+    doctext : document full text
     overwrite_on_dup: on file duplicate (filehash match), even if the filename is different
                 'n' -> do not overwrite existing index, 'y' -> overwrite existing index
-    
-    In case of Solr errors, application exits
     """
+    global _ft_buffer_bytes
+    data = {"id":dochash,
+            "docts": docts,
+            "docpath":docpath,
+            "doctext":doctext}
+    with _ft_lock:
+        _ft_buffer.append(data)
+        # utf-8 bytes of the text, as posted
+        _ft_buffer_bytes += len(doctext.encode())
+        isfull = len(_ft_buffer) >= _FT_BATCH_DOCS or _ft_buffer_bytes >= _FT_BATCH_BYTES
+    if isfull:
+        flush_fulltext(overwrite_on_dup, tlsverify)
+
+def flush_fulltext(overwrite_on_dup='n', tlsverify=False) -> None:
+    """Index the buffered full texts into Solr, call before the final commit """
+    global _ft_buffer_bytes
+    with _ft_lock:
+        docs = _ft_buffer.copy()
+        _ft_buffer.clear()
+        _ft_buffer_bytes = 0
+    if not docs:
+        return
     # Do not overwrite existing index if the filehash matches
     #overwrite: Ignore uniqueness check on index, can speed up writes to Solr
     #_version_ : controls updates, if the document exists, the updates will be rejected
@@ -135,73 +249,236 @@ def index_fulltext(flname, overwrite_on_dup='n', tlsverify=False) -> None:
         params = {"overwrite": "false", "_version_": -1}
     else:
         params = {"overwrite": "true"}
-    fname = flname.as_posix()
-    data = {"id":dlgdoc.doc.origin.binary_hash,
-            "docts": flname.stat().st_mtime,
-            "docpath":fname,
-            "doctext":dlgdoc.fulltext}
+    _index_ftdocs(docs, params, tlsverify)
+
+def _index_ftdocs(docs: list, params: dict, tlsverify: bool) -> None:
+    """POST the documents (json array) to Solr
+    In case of Solr errors, application exits
+    """
+    data = orjson.dumps(docs)
+    # Solr responds after indexing the whole batch, timeout scales with the batch size
+    timeout = max(_POST_TIMEOUT, _FT_POST_TIMEOUT * len(data) / _FT_BATCH_BYTES)
     try:
-        resp = requestsession.requests_post("fulltext", data=data, params=params, verify=tlsverify)
+        resp = requestsession.requests_post("fulltext", data=data, params=params, verify=tlsverify,
+                                            timeout=timeout)
     except Exception as exc:
         _lgrft.error("Unable to make a POST")
         _lgrft.error(exc)
-        _lgrft.error("Data:%s", data)
+        _lgrft.error("Data:%s", docs)
         print("Unable to post to full text indexing. Check the logs. Exiting...")
         sys.exit(1)
     if resp.ok:
-        _lgrft.info("Indexed: %s, status: %s", fname, resp.status_code)
-    else:
-        # version conflict due to existing document
-        if resp.status_code == 409:
-            _lgrft.info("Ignore: %s, already exists - filehash: %s", fname, dlgdoc.doc.origin.binary_hash)
+        for doc in docs:
+            _lgrft.info("Indexed: %s, status: %s", doc["docpath"], resp.status_code)
+    # version conflict due to existing document
+    elif resp.status_code == 409:
+        if len(docs) > 1:
+            # Solr stops the batch at the conflict, the rest of the batch may not be indexed
+            _lgrft.info("Version conflict in batch, indexing %s documents one at a time", len(docs))
+            for doc in docs:
+                _index_ftdocs([doc], params, tlsverify)
         else:
-            _lgrft.error("Full text index failed:%s, status:%s", fname, resp.status_code)
-            _lgrft.error(resp.text)
-            _lgrft.error("Data:%s", data)
-            print("Error during full text indexing. Check the logs. Exiting...")
-            sys.exit(1)
+            _lgrft.info("Ignore: %s, already exists - filehash: %s", docs[0]["docpath"], docs[0]["id"])
+    else:
+        _lgrft.error("Full text index failed:%s, status:%s", [doc["docpath"] for doc in docs], resp.status_code)
+        _lgrft.error(resp.text)
+        _lgrft.error("Data:%s", docs)
+        print("Error during full text indexing. Check the logs. Exiting...")
+        sys.exit(1)
 
-def index_embds(flname, overwrite_on_dup='n', tlsverify=False) -> None:
+def index_embds(docpath: str, dochash: int, chunks: list, overwrite_on_dup='n', tlsverify=False) -> None:
     """Index document chunks with embeddings into OpenSearch
     If Solr is used instead of OpenSearch, make changes to this function
     
     Inputs
     --------
-    flname : Path object
+    docpath : file path (posix)
+    dochash : document hash (docling binary_hash), used in the chunk ids
+    chunks : document chunk texts
     
-    In case of OpenSearch errors, application exists
+    The embeddings are generated on the calling (main) thread, one model user at a time
+    The bulk POSTs run on the io pool. In case of OpenSearch errors, application exists
     """
     if overwrite_on_dup =='n':
         indxtype = "create"
     else:
         indxtype = "index"
 
-    data = ""
+    lines = []
+    nbytes = 0
     # iterate over the embeddings and build the newline json data
-    for cntr, line in enumerate(dlgdoc.get_embeddings_for_vdb(flname)):
+    # Large documents are posted in several bulk requests, limited by chunk count and size
+    for cntr, line in enumerate(dlgdoc.get_embeddings_for_vdb(docpath, chunks)):
         # Using the file hash + chunks numbering as the unique id
-        indx_name = {f"{indxtype}": {"_index":_VECINDEX, "_id":f"{dlgdoc.doc.origin.binary_hash}{cntr}"}}
-        data = f"{data}{json.dumps(indx_name)}\n{json.dumps(line)}\n"
+        indx_name = {f"{indxtype}": {"_index":_VECINDEX, "_id":f"{dochash}{cntr}"}}
+        lines.append(orjson.dumps(indx_name))
+        lines.append(orjson.dumps(line, option=orjson.OPT_SERIALIZE_NUMPY))
+        nbytes += len(lines[-2]) + len(lines[-1])
+        if len(lines) >= 2*_VEC_BULK_DOCS or nbytes >= _VEC_BULK_BYTES:
+            submit_io(_bulk_embds, docpath, dochash, lines, tlsverify)
+            lines = []
+            nbytes = 0
+    if lines:
+        submit_io(_bulk_embds, docpath, dochash, lines, tlsverify)
+
+def _bulk_embds(docpath: str, dochash: int, lines: list, tlsverify: bool) -> None:
+    """POST the newline json lines (bulk) to OpenSearch
+    In case of OpenSearch errors, application exists
+    """
+    data = b'\n'.join(lines) + b'\n'
     try:
         resp = requestsession.requests_post("vec", data=data, verify=tlsverify)
     except Exception as exc:
         _lgremb.error("Unable to make a POST for embeddings")
         _lgremb.error(exc)
-        _lgremb.error("vectorDB Data:%s", data)
+        _lgremb.error("vectorDB Data:%s", data.decode())
         print("Unable to post to vectorDB. Check the logs. Exiting...")
         sys.exit(1)
-    if (resp.ok and resp.json()["errors"]) or not resp.ok:
+    if not resp.ok:
+        _lgremb.error("Chunks index failed:%s, status:%s", docpath, resp.status_code)
+        _lgremb.error(resp.text)
+        _lgremb.error("vectorDB Data:%s", data.decode())
+        print("Error during saving to vectorDB. Check the logs. Exiting...")
+        sys.exit(1)
+    resp_json = resp.json()
+    if resp_json["errors"]:
+        # Check every item, bulk request reports the errors per item
+        errs = [item["error"] for each in resp_json["items"] for item in each.values() if "error" in item]
         # If indxtype = "create", and there is a duplicate will result in version conflict code
-        if resp.json()["items"][0]["create"]["error"]["type"] == "version_conflict_engine_exception":
-            _lgremb.info("Ignore embeddings for: %s, already exists - filehash: %s", flname, dlgdoc.doc.origin.binary_hash)
+        if all(err["type"] == "version_conflict_engine_exception" for err in errs):
+            _lgremb.info("Ignore embeddings for: %s, already exists - filehash: %s", docpath, dochash)
         else:
-            _lgremb.error("Chunks index failed:%s", flname)
-            _lgremb.error(resp.json())
-            _lgremb.error("vectorDB Data:%s", data)
+            _lgremb.error("Chunks index failed:%s", docpath)
+            _lgremb.error(errs)
+            _lgremb.error("vectorDB Data:%s", data.decode())
             print("Error during saving to vectorDB. Check the logs. Exiting...")
             sys.exit(1)
     else:
-        _lgremb.info("Embeddings: %s, status: %s", flname, resp.status_code)
+        _lgremb.info("Embeddings: %s, status: %s", docpath, resp.status_code)
+
+# Indexing runs on the io pool threads, overlaps with the next document conversion
+_io_futures = deque()
+
+def submit_io(func, *args) -> None:
+    """ Submit an indexing function to the io pool
+    Raises the indexing errors(exit) of the completed functions
+    Waits when too many documents are pending, limits the memory held by the snapshots
+    """
+    _io_futures.append(io_pool.submit(func, *args))
+    while _io_futures and (_io_futures[0].done() or len(_io_futures) > _IO_MAX_PENDING):
+        _io_futures.popleft().result()
+
+def wait_io() -> None:
+    """ Wait for all the submitted indexing functions """
+    while _io_futures:
+        _io_futures.popleft().result()
+
+def _init_worker() -> None:
+    """ Conversion pool worker, owns a DoclingOps instance """
+    global dlgdoc
+    dlgdoc = DoclingOps(vecmdl=False)
+
+def convert_worker(fname: Path, shard: bytes=None, **convopts) -> tuple:
+    """ Runs in a conversion pool worker, shard: pdf bytes of a page range of the file
+    convopts: convert_doc options. Returns the document values, indexing is done by the main process
+    """
+    btime = datetime.now()
+    dlgdoc.convert_doc(fname, BytesIO(shard) if shard else None, **convopts)
+    return datetime.now() - btime, dlgdoc.doc.origin.binary_hash, dlgdoc.fulltext, dlgdoc.chunks
+
+def file_hash(fname: Path) -> int:
+    """ Document hash as Docling sets it (doc.origin.binary_hash), from the file bytes """
+    return int(create_file_hash(fname), 16) & 0xFFFFFFFFFFFFFFFF
+
+def pdf_shards(fname: Path) -> list:
+    """ Split a large pdf into _PDF_SHARD_PAGES page pdfs (bytes)
+    Docling converts the pages of a document serially, the shards are converted in parallel
+    Returns [] if the file is not a pdf or has less than _PDF_SHARD_MIN_PAGES pages
+    """
+    if not _PDF_SHARD_MIN_PAGES or fname.suffix.lower() != ".pdf":
+        return []
+    try:
+        pdf = pdfium.PdfDocument(fname)
+    except pdfium.PdfiumError:
+        # Not a valid pdf, docling reports the conversion error
+        return []
+    shards = []
+    try:
+        npages = len(pdf)
+        if npages < _PDF_SHARD_MIN_PAGES:
+            return []
+        for start in range(0, npages, _PDF_SHARD_PAGES):
+            shard = pdfium.PdfDocument.new()
+            shard.import_pages(pdf, list(range(start, min(start + _PDF_SHARD_PAGES, npages))))
+            buf = BytesIO()
+            shard.save(buf)
+            shard.close()
+            shards.append(buf.getvalue())
+    finally:
+        pdf.close()
+    return shards
+
+# Converted documents are indexed in the submission order
+_conv_futures = deque()
+
+def submit_conv(fname: Path, on_done, **convopts) -> None:
+    """ Submit a document (or its pdf shards) to the conversion pool
+    on_done(converted values) indexes the document, convopts: convert_doc options
+    Waits when all workers are busy and the queue is full
+    """
+    if shards := pdf_shards(fname):
+        futs = [conv_pool.submit(convert_worker, fname, shard, **convopts) for shard in shards]
+    else:
+        futs = [conv_pool.submit(convert_worker, fname, **convopts)]
+    _conv_futures.append((fname, futs, on_done))
+    while _conv_futures and (all(fut.done() for fut in _conv_futures[0][1])
+                             or len(_conv_futures) > 2 * _NUM_WORKERS):
+        _conv_done(*_conv_futures.popleft())
+
+def _conv_done(fname: Path, futs: list, on_done) -> None:
+    try:
+        parts = [fut.result() for fut in futs]
+        # Shards: the hash is of the file (not the shards)
+        dochash = file_hash(fname) if len(parts) > 1 else parts[0][1]
+    except Exception as exc:
+        _lgrm.error("%s: %s", fname.as_posix(), exc)
+        return
+    if len(parts) == 1:
+        on_done(parts[0])
+        return
+    # Merge the shards in page order
+    on_done((max(part[0] for part in parts), dochash,
+             " ".join(part[2] for part in parts), [chunk for part in parts for chunk in part[3]]))
+
+def wait_conv() -> None:
+    """ Wait for all the submitted conversions """
+    while _conv_futures:
+        _conv_done(*_conv_futures.popleft())
+
+def iter_files(root: Path, prevrun_dt: int=0):
+    """ Generator, (file, modified time) under the root folder and all subfolders, symlinks are ignored
+    Only files with modified time > prevrun_dt (the last ingestion time)
+    os.scandir entries cache the file type and stat, no extra syscalls per file
+    """
+    stack = [root]
+    while stack:
+        fldr = stack.pop()
+        try:
+            entries = list(os.scandir(fldr))
+        except OSError as exc:
+            _lgrm.error(exc)
+            continue
+        for entry in entries:
+            if entry.is_symlink():
+                _lgrm.info("Ignore symlink: %s", entry.path)
+            elif entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+                if (fts := int(mtime)) > prevrun_dt:
+                    yield Path(entry.path), mtime
+                else:
+                    _lgrm.info("Ignore:%s, file timestamp:%s <= %s", Path(entry.path).as_posix(), fts, prevrun_dt)
 
 def process_files(argsdct):
     """ Accepts a file or a folder and then extracts text. Ignores symlinks, will iterate a folder.
@@ -259,45 +536,65 @@ def process_files(argsdct):
     else:
         prevrun_dt = 0
 
-    def processfile(fname) -> None:
+    # Skip the fulltext export or the chunking if not indexed
+    convopts = {"need_fulltext": fulltext == 'y', "need_chunks": embeddings == 'y'}
+
+    def processfile(fname, mtime: float) -> None:
         """Invokes Docling, gets the fulltexts and text chunks 
            Depending on flags: indexes fulltext and/or text chunks with embeddings into vectorDB
+           With conversion workers, the document is converted in a worker process
+           mtime: file modified time, from the folder walk
         """
         flname = fname.as_posix()
+        # Skip the conversion of already indexed documents, even if the file name is different
+        if overwrite_on_dup == 'n':
+            try:
+                dochash = file_hash(fname)
+            except OSError as exc:
+                # Unreadable or removed during the walk
+                _lgrm.error(exc)
+                return
+            if is_indexed(dochash, fulltext, embeddings, tlsverify):
+                _lgrm.info("Ignore:%s, already indexed", flname)
+                return
+        if conv_pool:
+            submit_conv(fname, functools.partial(indexdoc, flname, mtime), **convopts)
+            return
         btime = datetime.now()
         try:
-            dlgdoc.convert_doc(fname)
+            dlgdoc.convert_doc(fname, **convopts)
         except Exception as exc:
             _lgrm.error(exc)
         else:
-            _lgrm.info("%s took %s", flname, precisedelta(datetime.now() - btime))
-            # Index embeddings and fulltext documents async
-            if fulltext == 'y':
-                # Use batch indexing, not one at a time
-                index_fulltext(fname, overwrite_on_dup, tlsverify)
-            if embeddings == 'y':
-                index_embds(fname, overwrite_on_dup, tlsverify)
+            indexdoc(flname, mtime, (datetime.now() - btime, dlgdoc.doc.origin.binary_hash,
+                                     dlgdoc.fulltext, dlgdoc.chunks))
+
+    def indexdoc(flname: str, mtime: float, converted: tuple) -> None:
+        """ converted: (conversion time, document hash, fulltext, chunk texts) """
+        took, dochash, doctext, chunks = converted
+        _lgrm.info("%s took %s", flname, precisedelta(took))
+        # Index embeddings and fulltext documents async, on the io pool
+        # dlgdoc is reused for the next document, pass a snapshot of the document values
+        if fulltext == 'y':
+            # Batch indexing, not one at a time
+            submit_io(index_fulltext, flname, mtime, dochash, doctext,
+                      overwrite_on_dup, tlsverify)
+        if embeddings == 'y':
+            # Encode here, only the bulk POSTs are submitted to the io pool
+            index_embds(flname, dochash, chunks, overwrite_on_dup, tlsverify)
 
     fl_cntr = 0
     print(f"Start:{(flname := fl_or_fldr.as_posix())} at {time.strftime('%x %X')}")
     print("...")
     _lgrm.info("Start: %s at %s", flname, time.strftime("%x %X"))
     if fl_or_fldr.is_dir():
-        for fname in fl_or_fldr.iterdir():
-            if fname.is_dir():
-                argsdct["fl_or_fldr"] = fname
-                process_files(argsdct)
-            elif fname.is_file() and not fname.is_symlink():
-                # Process files if file modified time > the last ingestion time
-                if (fts := int(fname.stat().st_mtime)) > prevrun_dt:
-                    fl_cntr += 1
-                    processfile(fname)
-                else:
-                    _lgrm.info("Ignore:%s, file timestamp:%s <= %s", fname.as_posix(), fts, prevrun_dt)
+        for fname, mtime in iter_files(fl_or_fldr, prevrun_dt):
+            fl_cntr += 1
+            processfile(fname, mtime)
     elif fl_or_fldr.is_file():
         # No mtime check when a single file is processed from the command line
         fl_cntr = 1
-        processfile(fl_or_fldr)
+        processfile(fl_or_fldr, fl_or_fldr.stat().st_mtime)
     _lgrm.info("End:%s at %s, Total files:%s", flname, time.strftime("%x %X"), fl_cntr)
     print(f"End:{flname} at {time.strftime('%x %X')}, Total files:{fl_cntr}")
 
@@ -324,7 +621,20 @@ if __name__ == '__main__':
     _lgremb = getlgr("embds")
     dlgdoc = DoclingOps()
     requestsession = RequestsOps()
+    io_pool = ThreadPoolExecutor(max_workers=_IO_WORKERS)
+    # Docling conversion is CPU heavy, convert documents in parallel processes
+    # spawn: CUDA is already initialized (embedding model), forked workers cannot use CUDA
+    conv_pool = None
+    if _NUM_WORKERS > 0:
+        conv_pool = ProcessPoolExecutor(max_workers=_NUM_WORKERS, initializer=_init_worker,
+                                        mp_context=multiprocessing.get_context("spawn"))
     process_files(vars(args))
+    if conv_pool:
+        wait_conv()
+        conv_pool.shutdown(wait=True)
+    wait_io()
+    io_pool.shutdown(wait=True)
+    flush_fulltext(args.overwrite_on_dup, args.tlsverify == 'y')
 
     # FT indexing is done without commit for performance.  Final commit before exiting
     try:
@@ -339,3 +649,4 @@ if __name__ == '__main__':
         _lgrm.error("Response error:%s", response.status_code)
         print("Full text index commit error. Check the logs. Exiting...")
     requestsession.requests_session_close()
+    dlgdoc.embcache_close()